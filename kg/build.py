@@ -1,19 +1,24 @@
 import csv
-import json
-import tqdm
-from itertools import combinations
-from collections import Counter
+import orjson
+import numba
+import numpy as np
+from numba import prange
+from functools import lru_cache
+from itertools import chain
+from collections import defaultdict
 import pandas as pd
 from indra.databases import mesh_client
 from indra.ontology.bio import bio_ontology
 
 
+@lru_cache(maxsize=None)
 def is_geoloc(x_db, x_id):
     if x_db == 'MESH':
         return mesh_client.mesh_isa(x_id, 'D005842')
     return False
 
 
+@lru_cache(maxsize=None)
 def is_pathogen(x_db, x_id):
     if x_db == 'MESH':
         return mesh_client.mesh_isa(x_id, 'D001419') or \
@@ -21,72 +26,161 @@ def is_pathogen(x_db, x_id):
     return False
 
 
+@lru_cache(maxsize=None)
 def is_disease(x_db, x_id):
     if x_db == 'MESH':
         return mesh_client.is_disease(x_id)
     return False
 
 
-# Some terms that are very common but too generic to be useful
-exclude_list = {'Disease', 'Health', 'Affected', 'control', 'Animals',
-                'infection', 'Viruses', 'vaccination', 'Vaccines',
-                'Therapeutics', 'Nature', 'event', 'Population',
-                'Epidemiology', 'Names', 'submitted', 'Laboratories',
-                'Disease Outbreaks', 'Central', 'strain'}
+# Some terms that are very common but too generic to be useful. Stored
+# casefolded; casefold names before checking membership.
+exclude_list = frozenset(
+    name.casefold() for name in
+    {'Disease', 'Health', 'Affected', 'control', 'Animals',
+     'infection', 'Viruses', 'vaccination', 'Vaccines',
+     'Therapeutics', 'Nature', 'event', 'Population',
+     'Epidemiology', 'Names', 'submitted', 'Laboratories',
+     'Disease Outbreaks', 'Central', 'strain'}
+)
+
+# Ordered pairs of term types that make up an interesting co-occurrence
+interesting_kind_pairs = {('geoloc', 'pathogen'), ('disease', 'pathogen'),
+                          ('geoloc', 'disease')}
+
+# Integer codes of term types used when counting pairs
+kind_codes = {None: 0, 'geoloc': 1, 'disease': 2, 'pathogen': 3}
+# Bit (kind_a << 2) | kind_b is set if terms of kind_a and kind_b, in
+# either order, make up an interesting pair
+interesting_kind_bitmap = sum({
+    1 << ((kind_codes[x] << 2) | kind_codes[y])
+    for kind_a, kind_b in interesting_kind_pairs
+    for x, y in ((kind_a, kind_b), (kind_b, kind_a))
+})
 
 outbreak_df = pd.read_csv('../output/promed_updates.csv',
                               dtype={"archiveNumber":str})
 outbreak_df["archiveNumber"] = outbreak_df["archiveNumber"].apply(
     lambda archive_number: archive_number.replace("\"", ""))
 
+def build_term_kind(terms_by_alert):
+    # Classify each distinct term once up front so that assembly loops
+    # only need dict lookups instead of MeSH hierarchy walks
+    unique_terms = {(db, id) for terms in terms_by_alert.values()
+                    for db, id, _ in terms}
+    return {k: ('pathogen' if is_pathogen(*k) else
+                'geoloc' if is_geoloc(*k) else
+                'disease' if is_disease(*k) else None)
+            for k in unique_terms}
+
+
+@numba.njit(parallel=True, cache=True)
+def _pair_keys_kernel(offsets, term_ids, kind_arr, bitmap, n_terms):
+    # Each alert writes the keys of its interesting pairs (a, b), encoded as
+    # a * n_terms + b, into its own slice of a shared array sized for all of
+    # its pairs, so alerts can be processed in parallel without merging.
+    # Unused slots are left as -1 and dropped at the end.
+    n_alerts = len(offsets) - 1
+    max_pairs = np.zeros(n_alerts + 1, dtype=np.int64)
+    for alert in prange(n_alerts):
+        n = offsets[alert + 1] - offsets[alert]
+        max_pairs[alert + 1] = n * (n - 1) // 2
+    pair_offsets = np.cumsum(max_pairs)
+    keys = np.full(pair_offsets[-1], -1, dtype=np.int64)
+    for alert in prange(n_alerts):
+        pos = pair_offsets[alert]
+        start, end = offsets[alert], offsets[alert + 1]
+        for i in range(start, end):
+            a = term_ids[i]
+            for j in range(i + 1, end):
+                b = term_ids[j]
+                if (bitmap >> ((kind_arr[a] << 2) | kind_arr[b])) & 1:
+                    keys[pos] = a * n_terms + b
+                    pos += 1
+    return keys[keys >= 0]
+
+
+def count_pairs(alert_terms, kinds):
+    # alert_terms is a list of sorted term index lists, one per alert, and
+    # kinds gives the type of each term by its index. The term lists are
+    # flattened into a single array with offsets per alert for the kernel.
+    # Returns arrays of the first and second term index of each pair and
+    # the pair's count.
+    offsets = np.zeros(len(alert_terms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(terms) for terms in alert_terms])
+    term_ids = np.fromiter(chain.from_iterable(alert_terms), dtype=np.int64,
+                           count=offsets[-1])
+    kind_arr = np.array([kind_codes[kind] for kind in kinds], dtype=np.int64)
+    n_terms = len(kinds)
+    keys = _pair_keys_kernel(offsets, term_ids, kind_arr,
+                             interesting_kind_bitmap, n_terms)
+    keys, counts = np.unique(keys, return_counts=True)
+    return keys // n_terms, keys % n_terms, counts
+
+
 def assemble_coocurrence():
-    with open('../output/promed_ner_terms_by_alert.json', 'r') as f:
-        jj = json.load(f)
-
-    pairs = []
-    interesting_pairs = []
-    for alert in tqdm.tqdm(jj):
-        for a, b in combinations(alert, 2):
-            # Normalize for arbitrary order
-            a, b = tuple(sorted([a, b], key=lambda x: x[2]))
-            if a[2] in exclude_list or b[2] in exclude_list:
-                continue
-            for a_, b_ in ((a, b), (b, a)):
-                if (is_geoloc(a_[0], a_[1]) and is_pathogen(b_[0], b_[1])) \
-                    or (is_disease(a_[0], a_[1]) and is_pathogen(b_[0], b_[1])) \
-                    or (is_geoloc(a_[0], a_[1]) and is_disease(b_[0], b_[1])):
-                    interesting_pairs.append((tuple(a), tuple(b)))
-            pairs.append((tuple(a), tuple(b)))
+    with open('../output/promed_ner_terms_by_alert.json', 'rb') as f:
+        jj = orjson.loads(f.read())
+
+    unique_terms = {(db, id): name for alert in jj.values()
+                    for db, id, name in alert}
+    term_kind = build_term_kind(jj)
+
+    # Only typed, non-excluded terms can be part of an interesting pair
+    # so only those are indexed and paired up when counting. Indices
+    # are assigned in name order so that pairs are counted on ints and come
+    # out normalized for arbitrary order.
+    terms = sorted((k for k, name in unique_terms.items()
+                    if term_kind[k] and name.casefold() not in exclude_list),
+                   key=lambda k: (unique_terms[k], k))
+    term_idx = {k: idx for idx, k in enumerate(terms)}
+    kinds = [term_kind[k] for k in terms]
+    alert_terms = [sorted(term_idx[(db, id)] for db, id, _ in alert
+                          if (db, id) in term_idx)
+                   for alert in jj.values()]
+    starts, ends, counts = count_pairs(alert_terms, kinds)
 
     node_header = ['curie:ID', 'name:string', ':TYPE']
     edge_header = [':START_ID', ':TYPE', ':END_ID', 'count:int']
 
-    nodes = set()
-    for pair in interesting_pairs:
-        for x in pair:
-            if is_pathogen(x[0], x[1]):
-                ntype = 'pathogen'
-            elif is_geoloc(x[0], x[1]):
-                ntype = 'geoloc'
-            else:
-                ntype = 'disease'
-            nodes.add((x[0] + ':' + x[1], x[2], ntype))
-
-    cnt = Counter(interesting_pairs)
-    edges = set()
-    for (a, b), count in cnt.items():
-        edges.add((a[0] + ':' + a[1], 'occurs_with', b[0] + ':' + b[1], count))
-    with open('../kg/edges.tsv', 'w') as fh:
+    curies = [db + ':' + id for db, id in terms]
+    nodes = {(curies[idx], unique_terms[terms[idx]], kinds[idx])
+             for idx in np.union1d(starts, ends).tolist()}
+    edges = {(curies[a], 'occurs_with', curies[b], count)
+             for a, b, count in zip(starts.tolist(), ends.tolist(),
+                                    counts.tolist())}
+    with open('../kg/edges.tsv', 'w', newline='') as fh:
         writer = csv.writer(fh, delimiter='\t')
-        writer.writerows([edge_header] + list(edges))
-    with open('../kg/nodes.tsv', 'w') as fh:
+        writer.writerow(edge_header)
+        writer.writerows(edges)
+    with open('../kg/nodes.tsv', 'w', newline='') as fh:
         writer = csv.writer(fh, delimiter='\t')
-        writer.writerows([node_header] + list(nodes))
+        writer.writerow(node_header)
+        writer.writerows(nodes)
+
+
+@lru_cache(maxsize=None)
+def get_mesh_isa_parents():
+    # Collect the isa parents of all MeSH terms in a single pass over the
+    # ontology graph rather than querying the ontology term by term.
+    # Iterating edges() doesn't trigger the ontology's lazy loading, so it
+    # is initialized explicitly, and the cache makes sure this only happens
+    # once.
+    bio_ontology.initialize()
+    parents = defaultdict(list)
+    for source, target, rel_type in bio_ontology.edges(data='type'):
+        if rel_type != 'isa':
+            continue
+        ns, id = bio_ontology.get_ns_id(source)
+        if ns == 'MESH':
+            parents[id].append(target)
+    return parents
 
 
 def assemble_mesh_hierarchy():
     edges = set()
     nodes = set()
+    mesh_isa_parents = get_mesh_isa_parents()
     # Assemble the subtree of diseases, pathogens and geolocations
     for mesh_id, mesh_name in mesh_client.mesh_id_to_name.items():
         is_dis = is_disease('MESH', mesh_id)
@@ -101,9 +195,7 @@ def assemble_mesh_hierarchy():
         else:
             node_type = 'geoloc'
         nodes.add((f'MESH:{mesh_id}', mesh_name, node_type))
-        parents_ids = list(bio_ontology.child_rel('MESH', mesh_id, {'isa'}))
-        parent_mesh_terms = [':'.join(parent) for parent in parents_ids]
-        new_edges = set()
+        parent_mesh_terms = mesh_isa_parents.get(mesh_id, [])
         for parent in parent_mesh_terms:
             if is_dis and not is_disease('MESH', parent):
                 continue
@@ -111,17 +203,18 @@ def assemble_mesh_hierarchy():
                 continue
             if is_geo and not is_geoloc('MESH', parent):
                 continue
-            new_edges.add((f'MESH:{mesh_id}', 'isa', parent))
-        edges |= new_edges
+            edges.add((f'MESH:{mesh_id}', 'isa', parent))
     # TODO: add relations to root nodes
     node_header = ['curie:ID', 'name:string', ':LABEL']
     edge_header = [':START_ID', ':TYPE', ':END_ID']
-    with open('../kg/mesh_hierarchy_edges.tsv', 'w') as fh:
+    with open('../kg/mesh_hierarchy_edges.tsv', 'w', newline='') as fh:
         writer = csv.writer(fh, delimiter='\t')
-        writer.writerows([edge_header] + list(edges))
-    with open('../kg/mesh_hierarchy_nodes.tsv', 'w') as fh:
+        writer.writerow(edge_header)
+        writer.writerows(edges)
+    with open('../kg/mesh_hierarchy_nodes.tsv', 'w', newline='') as fh:
         writer = csv.writer(fh, delimiter='\t')
-        writer.writerows([node_header] + list(nodes))
+        writer.writerow(node_header)
+        writer.writerows(nodes)
 
 def assemble_outbreak_nodes():
     nodes = set()
@@ -138,16 +231,19 @@ def assemble_outbreak_nodes():
                    f"outbreak:{outbreak_id}"))
     node_header = ['curie:ID', 'name:string', ':LABEL']
     edge_header = [':START_ID', ':TYPE', ':END_ID']
-    with open('../kg/promed_outbreak_nodes.tsv', 'w') as fh:
+    with open('../kg/promed_outbreak_nodes.tsv', 'w', newline='') as fh:
         writer = csv.writer(fh, delimiter='\t')
-        writer.writerows([node_header] + list(nodes))
-    with open('../kg/promed_alert_outbreak_edges.tsv', 'w') as fh:
+        writer.writerow(node_header)
+        writer.writerows(nodes)
+    with open('../kg/promed_alert_outbreak_edges.tsv', 'w', newline='') as fh:
         writer = csv.writer(fh, delimiter='\t')
-        writer.writerows([edge_header] + list(edges))
+        writer.writerow(edge_header)
+        writer.writerows(edges)
 
 def assemble_alert_relations():
-    with open('../output/promed_ner_terms_by_alert.json', 'r') as f:
-        terms_by_alert = json.load(f)
+    with open('../output/promed_ner_terms_by_alert.json', 'rb') as f:
+        terms_by_alert = orjson.loads(f.read())
+    term_kind = build_term_kind(terms_by_alert)
     nodes = set()
     edges = set()
     for archive_number, extractions in terms_by_alert.items():
@@ -160,19 +256,20 @@ def assemble_alert_relations():
         nodes.add((f'promed:{archive_number}', archive_number, time_stamp,
                    'alert'))
         for ns, id, entry_name in extractions:
-            if entry_name in exclude_list:
+            if entry_name.casefold() in exclude_list:
                 continue
-            if ns == 'MESH':
-                if is_disease(ns, id) or is_pathogen(ns, id) or is_geoloc(ns, id):
-                    edges.add((f'promed:{archive_number}', 'mentions', f'MESH:{id}'))
+            if ns == 'MESH' and term_kind.get((ns, id)) is not None:
+                edges.add((f'promed:{archive_number}', 'mentions', f'MESH:{id}'))
     node_header = ['curie:ID', 'name:string', 'timestamp:string', ':LABEL']
     edge_header = [':START_ID', ':TYPE', ':END_ID']
-    with open('../kg/promed_alert_nodes.tsv', 'w') as fh:
+    with open('../kg/promed_alert_nodes.tsv', 'w', newline='') as fh:
         writer = csv.writer(fh, delimiter='\t')
-        writer.writerows([node_header] + list(nodes))
-    with open('../kg/promed_alert_edges.tsv', 'w') as fh:
+        writer.writerow(node_header)
+        writer.writerows(nodes)
+    with open('../kg/promed_alert_edges.tsv', 'w', newline='') as fh:
         writer = csv.writer(fh, delimiter='\t')
-        writer.writerows([edge_header] + list(edges))
+        writer.writerow(edge_header)
+        writer.writerows(edges)
 
 def assemble_pathogen_disease_relations():
     import pyobo
@@ -196,9 +293,10 @@ def assemble_pathogen_disease_relations():
         if not mapped_id:
             continue
         edges.add((f'MESH:{source_id}', 'has_pathogen', f'MESH:{target_id}'))
-    with open('../kg/pathogen_disease_edges.tsv', 'w') as fh:
+    with open('../kg/pathogen_disease_edges.tsv', 'w', newline='') as fh:
         writer = csv.writer(fh, delimiter='\t')
-        writer.writerows([[':START_ID', ':TYPE', ':END_ID']] + list(edges))
+        writer.writerow([':START_ID', ':TYPE', ':END_ID'])
+        writer.writerows(edges)
     pass
 
 
@@ -212,9 +310,10 @@ def assemble_disease_symptom_relations():
         mesh_disease = row[':START_ID'].upper()
         mesh_pheno = row[':END_ID'].upper()
         edges.add((mesh_disease, 'has_phenotype', mesh_pheno))
-    with open('../kg/disease_phenotype_edges.tsv', 'w') as fh:
+    with open('../kg/disease_phenotype_edges.tsv', 'w', newline='') as fh:
         writer = csv.writer(fh, delimiter='\t')
-        writer.writerows([edge_header] + list(edges))
+        writer.writerow(edge_header)
+        writer.writerows(edges)
 
 
 if __name__ == '__main__':
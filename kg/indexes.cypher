@@ -0,0 +1,13 @@
+// Indexes and constraints on the properties used to look up nodes.
+// To confirm that a lookup uses an index, check for NodeIndexSeek in e.g.
+// PROFILE MATCH (d:disease {name: $disease}) RETURN d;
+CREATE INDEX disease_name IF NOT EXISTS FOR (n:disease) ON (n.name);
+CREATE INDEX pathogen_name IF NOT EXISTS FOR (n:pathogen) ON (n.name);
+CREATE INDEX geoloc_name IF NOT EXISTS FOR (n:geoloc) ON (n.name);
+CREATE INDEX outbreak_name IF NOT EXISTS FOR (n:outbreak) ON (n.name);
+CREATE INDEX alert_timestamp IF NOT EXISTS FOR (n:alert) ON (n.timestamp);
+CREATE CONSTRAINT disease_curie IF NOT EXISTS FOR (n:disease) REQUIRE n.curie IS UNIQUE;
+CREATE CONSTRAINT pathogen_curie IF NOT EXISTS FOR (n:pathogen) REQUIRE n.curie IS UNIQUE;
+CREATE CONSTRAINT geoloc_curie IF NOT EXISTS FOR (n:geoloc) REQUIRE n.curie IS UNIQUE;
+CREATE CONSTRAINT alert_curie IF NOT EXISTS FOR (n:alert) REQUIRE n.curie IS UNIQUE;
+CREATE CONSTRAINT outbreak_curie IF NOT EXISTS FOR (n:outbreak) REQUIRE n.curie IS UNIQUE;
@@ -15,5 +15,8 @@ done
 
 neo4j status
 
+echo "Creating indexes"
+cypher-shell -a "$NEO4J_URL" -f /sw/indexes.cypher
+
 echo "Keeping the container running by monitoring docker neo4j logs"
 tail -f /var/log/neo4j/neo4j.log
@@ -2,13 +2,14 @@
 import os
 import re
 import glob
-import json
-import pickle
 import datetime
+from concurrent.futures import ProcessPoolExecutor
 from collections import Counter, defaultdict
 
 import tqdm
 import gilda
+import gilda.ner
+import orjson
 import pystow
 from indra.sources.eidos.cli import extract_from_directory
 
@@ -17,6 +18,12 @@ from indra.sources.eidos.cli import extract_from_directory
 #GILDA_NS = ['MESH', 'EFO', 'HP', 'DOID', 'GO']
 GILDA_NS = ['MESH']
 EXCLUDE = {'J', 'one', 'news', 'large', 'go', 'cut', 'white', 'Kelly'}
+# The grounder reused for all annotations in a process, see get_grounder
+GROUNDER = None
+# Patterns for the fields of ProMED alert headers
+DATE_RE = re.compile(r'Published Date: (.+)\n')
+SUBJECT_RE = re.compile(r'Subject:(.+?)\n')
+ARCHIVE_RE = re.compile(r'Archive Number: (\d{8}\.\d+)?')
 CHAIN_DATA_PATH = os.path.join(os.pardir, 'CHAIN', 'Data', 'ProMED')
 
 # This is a folder for large data artifacts, depending on pystow
@@ -46,8 +53,39 @@ def parse_contents_from_body(body):
     return contents
 
 
+def get_grounder():
+    # Load the grounder lazily so that importing this module, or running
+    # worker processes that don't annotate, doesn't load gilda's resources.
+    # This is also the initializer of the annotation worker pool.
+    global GROUNDER
+    if GROUNDER is None:
+        GROUNDER = gilda.get_grounder()
+    return GROUNDER
+
+
 def annotate(txt):
-    return gilda.annotate(txt, namespaces=GILDA_NS)
+    return gilda.ner.annotate(txt, grounder=get_grounder(),
+                              namespaces=GILDA_NS)
+
+
+def annotation_to_json(annotation):
+    # The groundings are added to the serialized match since they are
+    # needed downstream and can't be recovered from JSON via gilda
+    text, match, start_idx, end_idx = annotation
+    match_json = match.to_json()
+    match_json['groundings'] = sorted(match.get_groundings())
+    return [text, match_json, start_idx, end_idx]
+
+
+def _annotate_alert(args):
+    archive_number, body = args
+    # TODO: consider adding header['subject'] annotations here
+    return archive_number, [
+        {'title': [annotation_to_json(a) for a in annotate(content['title'])],
+         'content': [annotation_to_json(a)
+                     for a in annotate(content['content'])]}
+        for content in body
+    ]
 
 
 def run_eidos(input_folder, output_folder):
@@ -60,9 +98,9 @@ def parse_header(header):
     # Example: Published Date: 2016-04-28 16:59:45 EDT\nSubject: PRO/AH/EDR>
     # Lumpy skin disease - Bulgaria (06): bovine, spread, vaccination\nArchive Number: 20160428.4189378
     # We need to parse out the date, subject and archive number
-    date = re.search(r'Published Date: (.+)\n', header)
-    subject = re.search(r'Subject:(.+?)\n', header)
-    archive = re.search(r'Archive Number: (\d{8}\.\d+)?', header)
+    date = DATE_RE.search(header)
+    subject = SUBJECT_RE.search(header)
+    archive = ARCHIVE_RE.search(header)
     # Now parse the date into a datetime object
     date = date.group(1)
     subject = parse_subject(subject.group(1)) if subject else None
@@ -101,8 +139,32 @@ def dump_alert_for_eidos(alert, fname):
 
 
 def dump_alert_json(alert, fname):
-    with open(fname, 'w') as fh:
-        json.dump(alert, fh, indent=1, default=str)
+    # Datetimes are passed through to default=str to keep their format
+    with open(fname, 'wb') as fh:
+        fh.write(orjson.dumps(alert, default=str,
+                              option=orjson.OPT_INDENT_2 |
+                              orjson.OPT_PASSTHROUGH_DATETIME))
+
+
+def process_file(fname):
+    # Returns (archive number, CHAIN file name, alert) for each alert in
+    # the given CHAIN JSON file
+    chain_alert_json = os.path.basename(fname)
+    with open(fname, 'rb') as fh:
+        content = orjson.loads(fh.read())
+    file_alerts = []
+    for entry in content:
+        if entry['header'] == ['']:
+            continue
+        header = parse_header(entry['header'])
+        archive_number = header['archive_number']
+        if archive_number is None:
+            continue
+        assert len(entry['body']) == 1
+        contents = parse_contents_from_body(entry['body'][0])
+        alert = {'header': header, 'body': contents}
+        file_alerts.append((archive_number, chain_alert_json, alert))
+    return file_alerts
 
 
 if __name__ == '__main__':
@@ -116,69 +178,73 @@ if __name__ == '__main__':
     # appear in multiple JSON files. Therefore, here we use a defaultdict
     # and make each heading number to a list of JSON files.
     chain_alert_json_index = defaultdict(list)
-    for fname in tqdm.tqdm(fnames, desc='Processing alerts'):
-        chain_alert_json = os.path.basename(fname)
-        with open(fname, 'r') as fh:
-            content = json.load(fh)
-        for entry in content:
-            if entry['header'] == ['']:
-                continue
-            header = parse_header(entry['header'])
-            archive_number  = header['archive_number']
-            if archive_number is None:
-                continue
-            assert len(entry['body']) == 1
-            contents = parse_contents_from_body(entry['body'][0])
-            alert = {'header': header, 'body': contents}
-            alerts.append(alert)
-            dump_alert_json(alert,
-                            DATA_PATH.join('alerts',
-                                           name=f'{archive_number}.json'))
-            dump_alert_for_eidos(alert,
-                                 DATA_PATH.join('eidos_input',
-                                                name=f'{archive_number}.txt'))
-            chain_alert_json_index[archive_number].append(chain_alert_json)
+    # Files are parsed in parallel but alerts are dumped here, in file order,
+    # since the same archive number can appear in more than one file
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for file_alerts in tqdm.tqdm(executor.map(process_file, fnames,
+                                                  chunksize=16),
+                                     total=len(fnames),
+                                     desc='Processing alerts'):
+            for archive_number, chain_alert_json, alert in file_alerts:
+                alerts.append(alert)
+                dump_alert_json(alert,
+                                DATA_PATH.join('alerts',
+                                               name=f'{archive_number}.json'))
+                dump_alert_for_eidos(alert,
+                                     DATA_PATH.join('eidos_input',
+                                                    name=f'{archive_number}.txt'))
+                chain_alert_json_index[archive_number].append(chain_alert_json)
 
     # Run NER on alerts
-    annotations = defaultdict(list)
-    for alert in tqdm.tqdm(alerts, desc='Annotating alerts'):
-        for content in alert['body']:
-            annotations[alert['header']['archive_number']].append(
-                    # TODO: consider adding header['subject'] annotations here
-                    {'title': annotate(content['title']),
-                     'content': annotate(content['content'])}
-                )
-    annotations = dict(annotations)
-    with open(DATA_PATH.join(name='annotations.pkl'), 'wb') as fh:
-        pickle.dump(annotations, fh)
+    inputs = [(alert['header']['archive_number'], alert['body'])
+              for alert in alerts]
+    # Annotations are written one alert per line as they come in so that
+    # they don't need to be held in memory all at once
+    annotations_path = DATA_PATH.join(name='annotations.jsonl')
+    with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                             initializer=get_grounder) as executor, \
+            open(annotations_path, 'wb') as fh:
+        for archive_number, annotation_list in \
+                tqdm.tqdm(executor.map(_annotate_alert, inputs, chunksize=32),
+                          total=len(inputs), desc='Annotating alerts'):
+            # Alerts with no parsed contents get no entry, as before
+            if not annotation_list:
+                continue
+            fh.write(orjson.dumps({'aid': archive_number,
+                                   'ann': annotation_list}) + b'\n')
 
     # Gather NER statistics
-    terms_by_alert = {}
+    terms_by_alert = defaultdict(set)
     text_stats = []
-    for alert_id, annotation_list in annotations.items():
-        terms = set()
-        for annotation in annotation_list:
-            for key in ['title', 'content']:
-                for text, match, start_idx, end_idx in annotation[key]:
-                    # This is necessary because there can be subsumed terms
-                    # with a more desirable / prioritized namespace
-                    groundings = dict(match.get_groundings())
-                    # This loop goes in priority order
-                    for ns in GILDA_NS:
-                        if ns in groundings:
-                            # TODO: if we switch to groundings here, what
-                            # do we do about entry_name which would be
-                            # inconsistent?
-                            terms.add((match.term.db, match.term.id,
-                                       match.term.entry_name))
-                            text_stats.append((text, match.term.db,
-                                               match.term.id, match.term.entry_name))
-                            break
-        terms_by_alert[alert_id] = sorted(terms)
+    with open(annotations_path, 'rb') as fh:
+        for line in fh:
+            rec = orjson.loads(line)
+            terms = terms_by_alert[rec['aid']]
+            for annotation in rec['ann']:
+                for key in ['title', 'content']:
+                    for text, match, start_idx, end_idx in annotation[key]:
+                        # This is necessary because there can be subsumed
+                        # terms with a more desirable / prioritized namespace
+                        groundings = dict(match['groundings'])
+                        term = match['term']
+                        # This loop goes in priority order
+                        for ns in GILDA_NS:
+                            if ns in groundings:
+                                # TODO: if we switch to groundings here, what
+                                # do we do about entry_name which would be
+                                # inconsistent?
+                                terms.add((term['db'], term['id'],
+                                           term['entry_name']))
+                                text_stats.append((text, term['db'],
+                                                   term['id'],
+                                                   term['entry_name']))
+                                break
+    terms_by_alert = {alert_id: sorted(terms)
+                      for alert_id, terms in terms_by_alert.items()}
 
     # Dump terms by alert into a JSON file
-    with open('output/promed_ner_terms_by_alert.json', 'w') as fh:
-        json.dump(terms_by_alert, fh, indent=2)
+    with open('output/promed_ner_terms_by_alert.json', 'wb') as fh:
+        fh.write(orjson.dumps(terms_by_alert, option=orjson.OPT_INDENT_2))
 
     # Dump stats into a spreadsheet
     text_stats_cnt = Counter(text_stats)